@@ -0,0 +1,1103 @@
+"""Offline benchmark and load test for the download pipeline
+
+Runs the real handle_instagram_url against local stand-ins, all started in a
+separate process so they do not share the bot's event loop or memory:
+
+- a fake Instagram that serves generated post/reel/carousel pages (or the
+  saved pages in fixtures/, with --pages fixtures) and media, with
+  configurable latency and failure rate
+- a set of fake HTTP proxies, some of which fail or block in controlled ways
+- a stub Telegram Bot API that accepts messages and uploads
+
+Besides the default load test, --scenario runs focused checks that exit
+non-zero when the expected behaviour is not observed:
+
+- concurrency: N links at once finish in about the time of the slowest one
+- extraction: the JSON extractor against the old regex one on the saved
+  pages in fixtures/ (accuracy and pages per second; no fakes needed)
+- endpoints: endpoints failing in a scripted pattern, tried in the old
+  fixed order and in learned order (fallbacks, time to media)
+- webhook: a burst of links delivered by long polling and by POSTing
+  updates to the webhook route, taken in only and handled end to end
+  (capacity, latency, rejected requests)
+- streaming: memory per media download stays near the chunk size, and a
+  download cut off mid-body resumes with a Range request, byte for byte
+- workers: worker mode with 1, 2 and 4 worker processes taking jobs from
+  the SQLite queue (throughput until the queue drains)
+
+Example:
+    python benchmark.py --requests 200 --rate 20 --proxy-failure-rate 0.1
+    python benchmark.py --json > before.json
+    python benchmark.py --pages fixtures --requests 60
+    python benchmark.py --scenario concurrency --requests 30
+    python benchmark.py --scenario workers --worker-counts 1,2,4,8
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import shutil
+import resource
+import multiprocessing
+from types import SimpleNamespace
+
+import httpx
+import tornado.web
+import tornado.httpclient
+from tornado.iostream import StreamClosedError
+from tornado.netutil import bind_sockets
+from tornado.httpserver import HTTPServer
+
+TOKEN = "123456:BENCHMARK"
+
+
+# ---------------------------------------------------------------------------
+# Fake services (run in a child process)
+# ---------------------------------------------------------------------------
+
+STATS = {
+    "instagram_pages": 0,
+    "instagram_media": 0,
+    "instagram_failures": 0,
+    "instagram_range_requests": 0,
+    "instagram_cut_connections": 0,
+    "instagram_login_walls": 0,
+    "proxy_requests": {},
+    "proxy_failures": {},
+    "telegram_calls": {},
+}
+
+# Media bodies repeat this block; 251 is prime, so a resume at the wrong
+# offset shows up as a byte mismatch
+PATTERN = bytes(range(251)) * 264
+
+def media_bytes(offset, length):
+    """length (<= 64 KiB) bytes of the fake media body, starting at offset"""
+    start = offset % 251
+    return PATTERN[start:start + length]
+
+def verify_media(file_path, size):
+    """Whether a downloaded file holds exactly the fake media body"""
+    if os.path.getsize(file_path) != size:
+        return False
+    with open(file_path, 'rb') as f:
+        offset = 0
+        while offset < size:
+            chunk = f.read(65536)
+            if chunk != media_bytes(offset, len(chunk)):
+                return False
+            offset += len(chunk)
+    return True
+
+# Scripted endpoint failures: endpoint -> {content kind or '*': share of
+# requests answered with a login wall instead of the post}
+ENDPOINT_SCRIPTS = {
+    # Like the real site: the JSON endpoint wants a login
+    "default": {"/p/?__a=1": {"*": 1.0}},
+    # ... and /p/ mostly lacks a reel's media, which /reel/ has
+    "reels": {"/p/?__a=1": {"*": 1.0}, "/p/": {"reel": 0.9}},
+    # /p/ is walled off half the time for everything
+    "p-outage": {"/p/?__a=1": {"*": 1.0}, "/p/": {"*": 0.5}},
+    # Every endpoint answers (the default with --pages fixtures)
+    "open": {},
+}
+
+def post_kind(shortcode, carousel_share):
+    """Deterministic content type per shortcode: 'reel', 'photo' or 'carousel'"""
+    roll = random.Random(shortcode).random()
+    if roll < carousel_share:
+        return 'carousel'
+    return 'reel' if roll < carousel_share + (1 - carousel_share) * 0.7 else 'photo'
+
+def render_page(base_url, shortcode, args):
+    """A page shaped like Instagram's: lots of filler plus one embedded JSON document"""
+    kind = post_kind(shortcode, args.carousel_share)
+
+    def video(i):
+        return {
+            "pk": f"{shortcode}{i}",
+            "video_duration": 15.0,
+            "video_versions": [
+                {"url": f"{base_url}/media/{shortcode}_{i}_720.mp4", "width": 720, "height": 1280},
+                {"url": f"{base_url}/media/{shortcode}_{i}_480.mp4", "width": 480, "height": 854},
+            ],
+        }
+
+    def photo(i):
+        return {
+            "pk": f"{shortcode}{i}",
+            "image_versions2": {"candidates": [
+                {"url": f"{base_url}/media/{shortcode}_{i}_1080.jpg", "width": 1080, "height": 1350},
+                {"url": f"{base_url}/media/{shortcode}_{i}_320.jpg", "width": 320, "height": 400},
+            ]},
+        }
+
+    if kind == 'carousel':
+        item = {"pk": shortcode, "carousel_media": [
+            video(i) if i % 3 == 0 else photo(i) for i in range(args.carousel_items)
+        ]}
+    elif kind == 'reel':
+        item = video(0)
+    else:
+        item = photo(0)
+    item["code"] = shortcode
+
+    filler = "".join(
+        f'<script>requireLazy(["m{i}"],function(){{return {i};}});</script>\n' for i in range(args.page_filler)
+    )
+    blob = json.dumps({"require": [["ScheduledServerJS", "handle", None, [{"items": [item]}]]]})
+    return (
+        "<!DOCTYPE html><html><head><title>Instagram</title></head><body>\n"
+        f"{filler}<script type=\"application/json\" data-sjs>{blob}</script>\n"
+        "</body></html>"
+    )
+
+
+def fixture_page(manifest, base_url, shortcode, endpoint, filler):
+    """A saved page standing in for this shortcode's post, with its shortcode
+    and CDN links rewritten to point here; None if the page is not served at
+    this endpoint"""
+    fixtures = [fixture for fixture in manifest["fixtures"] if fixture["endpoint"]]
+    fixture = random.Random(shortcode).choice(fixtures)
+    # ?__a=1 answers with JSON only, and pages only come without it
+    if (fixture["endpoint"] == "/p/?__a=1") != (endpoint == "/p/?__a=1"):
+        return None
+    cdn = manifest["cdn"]
+    text = (
+        fixture["text"].replace(fixture["shortcode"], shortcode)
+        .replace(f"{cdn}/", f"{base_url}/media/")
+        .replace(f"{cdn}/".replace('/', '\\/'), f"{base_url}/media/".replace('/', '\\/'))
+    )
+    return fixture["file"], pad_page(text, filler)
+
+LOGIN_WALL = "<html><body>Login &bull; Instagram</body></html>"
+
+class FakeInstagramHandler(tornado.web.RequestHandler):
+    def initialize(self, args, manifest=None):
+        self.args = args
+        # Saved pages to serve instead of generated ones (--pages fixtures)
+        self.manifest = manifest
+
+    async def get(self, path):
+        args = self.args
+        if path == "__stats":
+            self.write(STATS)
+            return
+        if path == "probe":
+            self.write({"origin": "127.0.0.1"})
+            return
+
+        await asyncio.sleep(random.uniform(*args.instagram_latency))
+        if random.random() < args.instagram_failure_rate:
+            STATS["instagram_failures"] += 1
+            self.set_status(503)
+            return
+
+        media = re.match(r'media/(.+)\.(mp4|jpg)$', path)
+        if media:
+            STATS["instagram_media"] += 1
+            size = int(self.get_query_argument('size', 0)) or (
+                args.video_size if media.group(2) == 'mp4' else args.photo_size)
+            await self.send_media(size, float(self.get_query_argument('cut', 0)))
+            return
+
+        page = re.match(r'(p|reel)/([A-Za-z0-9_-]+)/$', path)
+        if not page:
+            self.set_status(404)
+            return
+        STATS["instagram_pages"] += 1
+        endpoint = "/p/?__a=1" if self.get_query_argument('__a', None) else f"/{page.group(1)}/"
+        failures = ENDPOINT_SCRIPTS[args.endpoint_script].get(endpoint, {})
+        kind = post_kind(page.group(2), args.carousel_share)
+        base_url = f"{self.request.protocol}://{self.request.host}"
+        served = None
+        if random.random() >= failures.get(kind, failures.get('*', 0.0)):
+            if self.manifest is None:
+                served = ('generated.html', render_page(base_url, page.group(2), args))
+            else:
+                served = fixture_page(self.manifest, base_url, page.group(2), endpoint, args.page_filler)
+        if served is None:
+            STATS["instagram_login_walls"] += 1
+            self.write(LOGIN_WALL if self.manifest is None else self.manifest["login_wall"])
+            return
+        name, body = served
+        if name.endswith('.json'):
+            self.set_header('Content-Type', 'application/json')
+        self.write(body)
+
+    async def send_media(self, size, cut=0.0):
+        """Serve a media body, honouring Range; with cut, drop the first
+        (non-Range) connection after that fraction of the body"""
+        start = 0
+        stop_at = None
+        range_header = self.request.headers.get('Range')
+        if range_header:
+            STATS["instagram_range_requests"] += 1
+            start = int(re.match(r'bytes=(\d+)-', range_header).group(1))
+            self.set_status(206)
+            self.set_header('Content-Range', f"bytes {start}-{size - 1}/{size}")
+        elif cut:
+            stop_at = int(size * cut)
+        self.set_header('Content-Length', str(size - start))
+        position = start
+        while position < size:
+            length = min(size - position, 65536)
+            if stop_at is not None and position + length > stop_at:
+                STATS["instagram_cut_connections"] += 1
+                self.request.connection.close()
+                return
+            self.write(media_bytes(position, length))
+            position += length
+            await self.flush()
+
+
+class FakeProxyHandler(tornado.web.RequestHandler):
+    """Forward proxy for absolute-form http:// requests, with scripted failures"""
+
+    def initialize(self, name, failure_rate, block_rate, latency, client):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.block_rate = block_rate
+        self.latency = latency
+        self.client = client
+
+    async def get(self, path):
+        STATS["proxy_requests"][self.name] = STATS["proxy_requests"].get(self.name, 0) + 1
+        await asyncio.sleep(random.uniform(*self.latency))
+        roll = random.random()
+        if roll < self.failure_rate:
+            STATS["proxy_failures"][self.name] = STATS["proxy_failures"].get(self.name, 0) + 1
+            self.set_status(502)
+            return
+        if roll < self.failure_rate + self.block_rate:
+            STATS["proxy_failures"][self.name] = STATS["proxy_failures"].get(self.name, 0) + 1
+            self.set_status(429)
+            return
+
+        headers = {k: v for k, v in self.request.headers.items() if k.lower() in ('range', 'user-agent', 'accept')}
+        async with self.client.stream('GET', self.request.uri, headers=headers) as response:
+            self.set_status(response.status_code)
+            for key in ('Content-Type', 'Content-Length', 'Content-Range'):
+                if key in response.headers:
+                    self.set_header(key, response.headers[key])
+            try:
+                async for chunk in response.aiter_raw():
+                    self.write(chunk)
+                    await self.flush()
+            except httpx.HTTPError:
+                # The origin cut the body short: pass that on to the client
+                self.request.connection.close()
+            except StreamClosedError:
+                # The client went away, e.g. the losing side of an endpoint race
+                pass
+
+
+class UpdateQueue:
+    """Updates waiting to be fetched with getUpdates"""
+
+    def __init__(self):
+        self.updates = []
+        self.arrived = asyncio.Event()
+
+    def put(self, update):
+        self.updates.append(update)
+        self.arrived.set()
+        self.arrived = asyncio.Event()
+
+    async def get(self, offset, timeout):
+        """Long poll: updates from offset on, waiting up to timeout for one to arrive"""
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates and timeout > 0:
+            try:
+                await asyncio.wait_for(self.arrived.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:100]
+
+
+class FakeUpdatesHandler(tornado.web.RequestHandler):
+    """POST an Update here to have getUpdates return it"""
+
+    def initialize(self, updates):
+        self.updates = updates
+
+    def post(self):
+        self.updates.put(json.loads(self.request.body))
+
+
+class FakeWebhookPushHandler(tornado.web.RequestHandler):
+    """Telegram's side of a webhook: POST {"url", "secret", "updates"} here to
+    have each update delivered to the bot, over at most 40 connections"""
+
+    async def post(self):
+        job = json.loads(self.request.body)
+        # Lighter than httpx, so the sender is not what limits the bot's intake
+        client = tornado.httpclient.AsyncHTTPClient(force_instance=True, max_clients=40)
+        statuses = {}
+
+        async def push(update):
+            response = await client.fetch(
+                job["url"], method='POST', body=json.dumps(update), raise_error=False,
+                headers={'X-Telegram-Bot-Api-Secret-Token': job["secret"]})
+            status = str(response.code)
+            statuses[status] = statuses.get(status, 0) + 1
+
+        try:
+            await asyncio.gather(*(push(update) for update in job["updates"]))
+        finally:
+            client.close()
+        self.write({"statuses": statuses})
+
+
+class FakeTelegramHandler(tornado.web.RequestHandler):
+    """Just enough of the Bot API for the handlers, telegram.Bot and polling"""
+
+    message_ids = iter(range(10 ** 6, 10 ** 9))
+
+    def initialize(self, latency, updates):
+        self.latency = latency
+        self.updates = updates
+
+    def message(self, chat_id, **extra):
+        return {"message_id": next(self.message_ids), "date": int(time.time()),
+                "chat": {"id": int(chat_id), "type": "private"}, **extra}
+
+    async def post(self, token, method):
+        STATS["telegram_calls"][method] = STATS["telegram_calls"].get(method, 0) + 1
+        await asyncio.sleep(random.uniform(*self.latency))
+        arg = self.get_body_argument
+        file_id = f"file{random.getrandbits(48):x}"
+        if method == 'getMe':
+            result = {"id": 123456, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot"}
+        elif method in ('sendMessage', 'editMessageText'):
+            result = self.message(arg('chat_id'), text=arg('text', ''))
+        elif method in ('deleteMessage', 'deleteWebhook', 'setWebhook'):
+            result = True
+        elif method == 'getUpdates':
+            result = await self.updates.get(int(arg('offset', 0) or 0), float(arg('timeout', 0) or 0))
+        elif method == 'sendVideo':
+            result = self.message(arg('chat_id'), video={
+                "file_id": file_id, "file_unique_id": file_id, "width": 720, "height": 1280, "duration": 15})
+        elif method == 'sendPhoto':
+            result = self.message(arg('chat_id'), photo=[
+                {"file_id": file_id, "file_unique_id": file_id, "width": 1080, "height": 1350}])
+        elif method == 'sendMediaGroup':
+            result = []
+            for item in json.loads(arg('media')):
+                item_id = f"file{random.getrandbits(48):x}"
+                if item["type"] == 'video':
+                    result.append(self.message(arg('chat_id'), video={
+                        "file_id": item_id, "file_unique_id": item_id, "width": 720, "height": 1280, "duration": 15}))
+                else:
+                    result.append(self.message(arg('chat_id'), photo=[
+                        {"file_id": item_id, "file_unique_id": item_id, "width": 1080, "height": 1350}]))
+        else:
+            self.write({"ok": False, "error_code": 404, "description": f"Not Found: {method}"})
+            return
+        self.write({"ok": True, "result": result})
+
+
+def listen(app):
+    sockets = bind_sockets(0, '127.0.0.1')
+    server = HTTPServer(app)
+    server.add_sockets(sockets)
+    return sockets[0].getsockname()[1]
+
+def run_fakes(args, conn):
+    """Child process: start every fake service and report their ports"""
+    import logging
+    # Injected 5xx responses would otherwise be logged as errors
+    logging.getLogger('tornado.access').setLevel(logging.CRITICAL)
+
+    async def serve():
+        client = httpx.AsyncClient(timeout=60, limits=httpx.Limits(max_connections=500))
+        manifest = None
+        if args.pages == 'fixtures':
+            manifest = load_fixtures(args.fixtures)
+            walls = [f["text"] for f in manifest["fixtures"] if not f["endpoint"]]
+            manifest["login_wall"] = walls[0] if walls else LOGIN_WALL
+        instagram_port = listen(tornado.web.Application([
+            (r"/(.*)", FakeInstagramHandler, {"args": args, "manifest": manifest}),
+        ]))
+        proxy_ports = []
+        for i in range(args.proxies):
+            # The first --bad-proxies proxies fail a lot more than the rest
+            failure_rate = args.bad_proxy_failure_rate if i < args.bad_proxies else args.proxy_failure_rate
+            proxy_ports.append(listen(tornado.web.Application([(r"(.*)", FakeProxyHandler, {
+                "name": f"proxy{i}", "failure_rate": failure_rate, "block_rate": args.proxy_block_rate,
+                "latency": args.proxy_latency, "client": client,
+            })])))
+        updates = UpdateQueue()
+        telegram_port = listen(tornado.web.Application([
+            (r"/bot([^/]+)/(\w+)", FakeTelegramHandler, {"latency": args.telegram_latency, "updates": updates}),
+            (r"/__updates", FakeUpdatesHandler, {"updates": updates}),
+            (r"/__push", FakeWebhookPushHandler),
+        ]))
+        conn.send({"instagram": instagram_port, "proxies": proxy_ports, "telegram": telegram_port})
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+# ---------------------------------------------------------------------------
+# Load generator (runs in this process, against the real bot module)
+# ---------------------------------------------------------------------------
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(int(round(pct / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+def pick_shortcodes(args):
+    """Request stream with a Zipf-like popularity, so some links repeat"""
+    rng = random.Random(args.seed)
+    codes = [f"C{i:05d}bench" for i in range(args.shortcodes)]
+    weights = [1 / (rank + 1) ** args.zipf for rank in range(len(codes))]
+    return rng.choices(codes, weights=weights, k=args.requests)
+
+def import_bot(args, ports=None):
+    """Point the bot at the fakes (if running) and import it"""
+    if ports:
+        os.environ['INSTAGRAM_BASE_URL'] = f"http://127.0.0.1:{ports['instagram']}"
+        os.environ['PROXY_PROBE_URL'] = f"http://127.0.0.1:{ports['instagram']}/probe"
+        os.environ['PROXY_LIST'] = ",".join(f"http://127.0.0.1:{port}" for port in ports['proxies'])
+    os.environ.setdefault('PROXY_FILE', '')
+
+    # Imported only now, because the bot reads its configuration at import time
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import logging
+    import bot
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.ERROR)
+    return bot
+
+def telegram_bot(ports):
+    from telegram import Bot
+    from telegram.request import HTTPXRequest
+    return Bot(TOKEN, base_url=f"http://127.0.0.1:{ports['telegram']}/bot",
+               request=HTTPXRequest(connection_pool_size=256, read_timeout=60, pool_timeout=60))
+
+def update_data(index, shortcode, args):
+    """Bot API Update JSON for a user sending a link"""
+    path = 'reel' if post_kind(shortcode, args.carousel_share) == 'reel' else 'p'
+    return {
+        "update_id": index,
+        "message": {
+            "message_id": index + 1,
+            "date": int(time.time()),
+            "chat": {"id": 1000 + index % args.users, "type": "private"},
+            "from": {"id": 1000 + index % args.users, "is_bot": False, "first_name": "user"},
+            "text": f"https://www.instagram.com/{path}/{shortcode}/",
+        },
+    }
+
+async def send_links(bot, telegram, args, shortcodes):
+    """Run handle_instagram_url for every link, returning (latencies, elapsed)"""
+    from telegram import Update
+    context = SimpleNamespace(bot=telegram)
+    latencies = []
+
+    async def one(index, shortcode):
+        update = Update.de_json(update_data(index, shortcode, args), telegram)
+        started = time.monotonic()
+        await bot.handle_instagram_url(update, context)
+        latencies.append(time.monotonic() - started)
+
+    # Open-loop arrivals at --rate requests per second
+    tasks = []
+    started = time.monotonic()
+    for index, shortcode in enumerate(shortcodes):
+        tasks.append(asyncio.create_task(one(index, shortcode)))
+        await asyncio.sleep(random.expovariate(args.rate) if args.rate > 0 else 0)
+    await asyncio.gather(*tasks)
+    return latencies, time.monotonic() - started
+
+async def fake_stats(ports):
+    async with httpx.AsyncClient() as client:
+        return (await client.get(f"http://127.0.0.1:{ports['instagram']}/__stats")).json()
+
+async def run_load(args, ports):
+    bot = import_bot(args, ports)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    outcomes = {}
+
+    async with telegram_bot(ports) as telegram:
+        await bot.downloader.start()
+        latencies, elapsed = await send_links(bot, telegram, args, pick_shortcodes(args))
+        await bot.downloader.close()
+
+    for key, value in bot.HANDLED_REQUESTS.values.items():
+        outcomes[key[0]] = int(value)
+    proxy_attempts = {}
+    for (proxy, outcome), value in bot.PROXY_REQUESTS.values.items():
+        proxy_attempts[outcome] = proxy_attempts.get(outcome, 0) + int(value)
+
+    return {
+        "requests": args.requests,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(args.requests / elapsed, 2) if elapsed else 0.0,
+        "latency_s": {
+            "p50": round(percentile(latencies, 50), 3),
+            "p95": round(percentile(latencies, 95), 3),
+            "p99": round(percentile(latencies, 99), 3),
+            "max": round(max(latencies, default=0.0), 3),
+        },
+        "peak_rss_mb": round(max(rss_before, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss) / 1024, 1),
+        "outcomes": outcomes,
+        "cache": bot.downloader.cache.stats(),
+        "bot_proxy_attempts": proxy_attempts,
+        "endpoint_fallbacks": int(sum(bot.ENDPOINT_FALLBACKS.values.values())),
+        "fakes": await fake_stats(ports),
+    }
+
+async def run_concurrency(args, ports):
+    """Distinct links sent all at once; if nothing blocks the event loop, the
+    wall time is close to the slowest request rather than the sum of them all"""
+    bot = import_bot(args, ports)
+    shortcodes = [f"C{i:05d}conc" for i in range(args.requests)]
+    async with telegram_bot(ports) as telegram:
+        await bot.downloader.start()
+        latencies, elapsed = await send_links(bot, telegram, args, shortcodes)
+        await bot.downloader.close()
+    slowest = max(latencies, default=0.0)
+    return {
+        "requests": len(shortcodes),
+        "wall_s": round(elapsed, 3),
+        "slowest_s": round(slowest, 3),
+        "sum_of_latencies_s": round(sum(latencies), 3),
+        # ~N when requests fully overlap, ~1 when they run one after another
+        "overlap": round(sum(latencies) / elapsed, 2) if elapsed else 0.0,
+        "outcomes": {key[0]: int(value) for key, value in bot.HANDLED_REQUESTS.values.items()},
+        "passed": elapsed <= slowest * 1.25 + 0.1,
+    }
+
+async def run_streaming(args, ports):
+    """Stream large media to disk and check memory stays near the chunk size,
+    then cut a connection mid-body and check the Range resume is byte-exact"""
+    import tracemalloc
+    import tempfile
+    bot = import_bot(args, ports)
+    downloader = bot.downloader
+    base_url = f"http://127.0.0.1:{ports['instagram']}/media"
+    size = args.video_size
+
+    async def download(name, cut=0.0):
+        with tempfile.NamedTemporaryFile(delete=False, suffix='.mp4') as f:
+            file_path = f.name
+        try:
+            url = f"{base_url}/{name}.mp4?size={size}" + (f"&cut={cut}" if cut else "")
+            written = await downloader.stream_to_file(url, file_path)
+            return written, verify_media(file_path, size)
+        finally:
+            os.unlink(file_path)
+
+    await downloader.start(probe=False)
+    # The first request imports parts of httpx and anyio lazily: keep that out
+    # of the measurement
+    with tempfile.NamedTemporaryFile(suffix='.mp4') as f:
+        await downloader.stream_to_file(f"{base_url}/warmup.mp4?size=65536", f.name)
+    tracemalloc.start()
+    started = time.monotonic()
+    results = await asyncio.gather(*(download(f"stream_{i}") for i in range(args.downloads)))
+    elapsed = time.monotonic() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    resumed_written, resumed_ok = await download("resume_0", cut=0.5)
+    await downloader.close()
+    fakes = await fake_stats(ports)
+
+    per_download = peak / args.downloads
+    return {
+        "downloads": args.downloads,
+        "file_mb": round(size / 1024 / 1024, 1),
+        "chunk_kb": downloader.chunk_size // 1024,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_mb_s": round(size * args.downloads / 1024 / 1024 / elapsed, 1) if elapsed else 0.0,
+        "traced_peak_kb": round(peak / 1024, 1),
+        "peak_per_download_kb": round(per_download / 1024, 1),
+        "peak_per_download_chunks": round(per_download / downloader.chunk_size, 1),
+        "all_bytes_correct": all(ok for _, ok in results),
+        "resume": {
+            "connections_cut": fakes["instagram_cut_connections"],
+            "range_requests": fakes["instagram_range_requests"],
+            "bytes_written": resumed_written,
+            "bytes_correct": resumed_ok,
+        },
+        "passed": (
+            all(ok for _, ok in results) and resumed_ok
+            and fakes["instagram_range_requests"] >= 1
+            # A few buffers of chunk size in httpx/h11, nowhere near the file size
+            and per_download < 16 * downloader.chunk_size
+        ),
+    }
+
+async def deliver_updates(bot, args, ports, mode, shortcodes, handle=True):
+    """Hand a burst of updates to a bot Application through a webhook or long
+    polling, all pending at once, returning (latencies from the start of the
+    burst to handled, elapsed, webhook statuses, rejected requests); without
+    handle, updates are only taken in, not acted on"""
+    from telegram.ext import Application, MessageHandler, filters
+    from telegram.request import HTTPXRequest
+    telegram_url = f"http://127.0.0.1:{ports['telegram']}"
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        .base_url(f"{telegram_url}/bot")
+        .request(HTTPXRequest(connection_pool_size=256, read_timeout=60, pool_timeout=60))
+        .get_updates_request(HTTPXRequest(read_timeout=60))
+        .concurrent_updates(True)
+        .build()
+    )
+    handled = {}
+    all_handled = asyncio.Event()
+
+    async def timed(update, context):
+        try:
+            if handle:
+                await bot.handle_instagram_url(update, context)
+        finally:
+            handled[update.update_id] = time.monotonic()
+            if len(handled) == len(shortcodes):
+                all_handled.set()
+
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed))
+    secret = "benchmark-secret"
+    app.bot_data['webhook_secret'] = secret
+    statuses = {}
+    updates = [update_data(index + 1, shortcode, args) for index, shortcode in enumerate(shortcodes)]
+
+    async with app, httpx.AsyncClient(timeout=600) as client:
+        if mode == 'webhook':
+            server = HTTPServer(bot.create_web_app(app))
+            sockets = bind_sockets(0, '127.0.0.1')
+            server.add_sockets(sockets)
+            target = f"http://127.0.0.1:{sockets[0].getsockname()[1]}{bot.WEBHOOK_PATH}"
+
+            async def send(data, token=secret, body=None):
+                response = await client.post(target, content=body or json.dumps(data),
+                                             headers={'X-Telegram-Bot-Api-Secret-Token': token})
+                return response.status_code
+
+            # Requests Telegram would never send must be turned away
+            rejected = {
+                "bad_secret": await send({}, token="wrong"),
+                "bad_body": await send(None, body=b"{not json"),
+                "not_an_object": await send(None, body=b'"x"'),
+                "not_an_update": await send({}),
+            }
+            await app.start()
+            started = time.monotonic()
+            # The fakes' process POSTs the updates, as Telegram would, so sending them
+            # costs the bot nothing
+            response = await client.post(f"{telegram_url}/__push", json={
+                "url": target, "secret": secret, "updates": updates})
+            statuses = response.json()["statuses"]
+        else:
+            # Telegram holds the backlog until the bot's next getUpdates
+            server = None
+            rejected = None
+            for data in updates:
+                await client.post(f"{telegram_url}/__updates", json=data)
+            started = time.monotonic()
+            await app.updater.start_polling(poll_interval=0, timeout=10)
+            await app.start()
+
+        await asyncio.wait_for(all_handled.wait(), 600)
+        elapsed = time.monotonic() - started
+
+        if app.updater.running:
+            await app.updater.stop()
+        await app.stop()
+        if server is not None:
+            server.stop()
+
+    latencies = [at - started for at in handled.values()]
+    return latencies, elapsed, statuses, rejected
+
+async def run_webhook(args, ports):
+    """The same burst of links through long polling and through the webhook,
+    taken in only and then handled end to end: the webhook must take updates
+    in well ahead of what the bot can act on, and turn away bad requests"""
+    bot = import_bot(args, ports)
+    shortcodes = pick_shortcodes(args)
+    report = {"requests": len(shortcodes)}
+    await bot.downloader.start()
+    # Download every post beforehand, so handling is answering from the file_id cache
+    async with telegram_bot(ports) as telegram:
+        await send_links(bot, telegram, args, sorted(set(shortcodes)))
+    for stage, handle in (('intake', False), ('end_to_end', True)):
+        report[stage] = {}
+        for mode in ('polling', 'webhook'):
+            latencies, elapsed, statuses, rejected = await deliver_updates(
+                bot, args, ports, mode, shortcodes, handle)
+            result = report[stage][mode] = {
+                "elapsed_s": round(elapsed, 3),
+                "throughput_rps": round(len(shortcodes) / elapsed, 2) if elapsed else 0.0,
+                "latency_p50_s": round(percentile(latencies, 50), 3),
+                "latency_p95_s": round(percentile(latencies, 95), 3),
+            }
+            if mode == 'webhook':
+                result["responses"] = statuses
+                result["rejected"] = rejected
+    await bot.downloader.close()
+    intake, end_to_end = report["intake"], report["end_to_end"]
+    report["passed"] = all(
+        report[stage]["webhook"]["responses"] == {"200": len(shortcodes)}
+        and report[stage]["webhook"]["rejected"] == {
+            "bad_secret": 403, "bad_body": 400, "not_an_object": 400, "not_an_update": 400}
+        for stage in ('intake', 'end_to_end')
+    ) and (
+        # One POST per update cannot match getUpdates' batches of 100, but taking
+        # updates in must never be what limits the bot
+        intake["webhook"]["throughput_rps"]
+        >= 2 * max(end_to_end[mode]["throughput_rps"] for mode in ('polling', 'webhook'))
+    )
+    return report
+
+async def run_endpoints(args, ports):
+    """Endpoints failing in a scripted pattern (--endpoint-script): the fixed
+    order the bot used to try them in, against the learned ranking"""
+    bot = import_bot(args, ports)
+    shortcodes = [f"C{i:05d}endp" for i in range(args.requests)]
+    downloader = bot.downloader
+    report = {"requests": len(shortcodes), "endpoint_script": args.endpoint_script}
+
+    def totals():
+        attempts = {}
+        for (_, outcome), value in bot.ENDPOINT_ATTEMPTS.values.items():
+            attempts[outcome] = attempts.get(outcome, 0) + int(value)
+        return int(sum(bot.ENDPOINT_FALLBACKS.values.values())), attempts
+
+    async with telegram_bot(ports) as telegram:
+        await downloader.start(probe=False)
+        for mode in ('fixed', 'learned'):
+            # Same links, same arrivals, nothing cached or learned beforehand
+            random.seed(args.seed)
+            downloader.cache = bot.ResultCache(bot.MemoryCacheBackend())
+            downloader.proxy_pool.stats = {proxy: bot.ProxyStats() for proxy in downloader.proxy_pool.proxies}
+            downloader.endpoint_ranker = bot.EndpointRanker(bot.INSTAGRAM_ENDPOINTS)
+            if mode == 'fixed':
+                ranker = downloader.endpoint_ranker
+                ranker.order = lambda content_type: list(ranker.names)
+            fallbacks_before, attempts_before = totals()
+            latencies, elapsed = await send_links(bot, telegram, args, shortcodes)
+            fallbacks_after, attempts_after = totals()
+            wasted = sum(attempts_after.get(outcome, 0) - attempts_before.get(outcome, 0)
+                         for outcome in ('no_media', 'fetch_failed'))
+            report[mode] = {
+                "fallbacks": fallbacks_after - fallbacks_before,
+                "wasted_page_fetches": wasted,
+                "time_to_media_p50_s": round(percentile(latencies, 50), 3),
+                "time_to_media_p95_s": round(percentile(latencies, 95), 3),
+            }
+        await downloader.close()
+
+    report["passed"] = (
+        report["learned"]["fallbacks"] < report["fixed"]["fallbacks"]
+        and report["learned"]["time_to_media_p50_s"] <= report["fixed"]["time_to_media_p50_s"]
+    )
+    return report
+
+async def run_workers(args, ports):
+    """Worker mode with 1, 2, 4... worker processes (--worker-counts): the same
+    links queued through handle_instagram_url, timed until the queue drains"""
+    import sqlite3
+    import tempfile
+    report = {"requests": args.requests, "download_concurrency": args.worker_concurrency}
+    state_dir = tempfile.mkdtemp(prefix='benchmark-workers-')
+    # Workers are fresh processes and read their configuration from the environment
+    os.environ.update({
+        'TELEGRAM_BASE_URL': f"http://127.0.0.1:{ports['telegram']}/bot",
+        'DOWNLOAD_CONCURRENCY': str(args.worker_concurrency),
+        'WORKER_POLL_INTERVAL': '0.05',
+        'LOG_LEVEL': 'INFO' if args.verbose else 'ERROR',
+    })
+    bot = import_bot(args, ports)
+
+    async with telegram_bot(ports) as telegram, httpx.AsyncClient() as client:
+        async def telegram_calls(method):
+            stats = (await client.get(f"http://127.0.0.1:{ports['instagram']}/__stats")).json()
+            return stats["telegram_calls"].get(method, 0)
+
+        for count in args.worker_counts:
+            # Every run gets its own queue, cache and proxy state: nothing carries over
+            paths = {name: os.path.join(state_dir, f"{name.lower()}-{count}.sqlite3")
+                     for name in ('JOB_QUEUE_PATH', 'CACHE_PATH', 'PROXY_STATE_PATH', 'METRICS_PATH')}
+            os.environ.update(paths)
+            bot.download_queue = bot.SQLiteJobQueue(paths['JOB_QUEUE_PATH'])
+            bot.metrics_store = bot.MetricsStore(paths['METRICS_PATH'])
+            bot.downloader.share_state(paths['CACHE_PATH'], paths['PROXY_STATE_PATH'])
+
+            # Each worker calls getMe once it is ready to claim jobs
+            ready_before = await telegram_calls('getMe')
+            pool = bot.WorkerPool(TOKEN, count)
+            pool.start()
+            while await telegram_calls('getMe') < ready_before + count:
+                await asyncio.sleep(0.1)
+
+            random.seed(args.seed)
+            shortcodes = [f"C{i:05d}wrk{count}" for i in range(args.requests)]
+            started = time.monotonic()
+            await send_links(bot, telegram, args, shortcodes)
+            with sqlite3.connect(paths['JOB_QUEUE_PATH']) as conn:
+                while conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]:
+                    await asyncio.sleep(0.05)
+            elapsed = time.monotonic() - started
+            await pool.stop()
+
+            # What /metrics reports for the links the workers handled
+            handled = sum(value for snapshot in bot.metrics_store.load()
+                          for _, value in snapshot.get(bot.HANDLED_REQUESTS.name, []))
+            report[f"{count}_workers"] = {
+                "elapsed_s": round(elapsed, 3),
+                "throughput_rps": round(args.requests / elapsed, 2) if elapsed else 0.0,
+                "handled_in_metrics": int(handled),
+            }
+    bot.download_queue = bot.metrics_store = None
+    shutil.rmtree(state_dir, ignore_errors=True)
+
+    first, last = args.worker_counts[0], args.worker_counts[-1]
+    report["speedup"] = round(
+        report[f"{last}_workers"]["throughput_rps"] / report[f"{first}_workers"]["throughput_rps"], 2)
+    # Workers share one machine with the fakes, so ask for clear gains, not linear ones
+    report["passed"] = (
+        (last <= first or report["speedup"] >= 1 + (last / first - 1) / 3)
+        and all(report[f"{count}_workers"]["handled_in_metrics"] == args.requests for count in args.worker_counts)
+    )
+    return report
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+def load_fixtures(directory=FIXTURES_DIR):
+    """Saved pages listed in the fixture manifest, with their text loaded"""
+    with open(os.path.join(directory, 'manifest.json')) as f:
+        manifest = json.load(f)
+    for fixture in manifest["fixtures"]:
+        with open(os.path.join(directory, fixture["file"]), encoding='utf-8') as f:
+            fixture["text"] = f.read()
+    return manifest
+
+def legacy_extract_media(html_content):
+    """The regex extractor the bot used before the JSON parser, kept for comparison"""
+    try:
+        # Look for video URL
+        video_patterns = [
+            r'"video_url":"([^"]+)"',
+            r'videoUrl":"([^"]+)"',
+            r'"src":"([^"]*\.mp4[^"]*)"'
+        ]
+
+        for pattern in video_patterns:
+            match = re.search(pattern, html_content)
+            if match:
+                video_url = match.group(1).replace('\\u0026', '&').replace('\\/', '/')
+                return video_url, 'video'
+
+        # Look for image URL
+        image_patterns = [
+            r'"display_url":"([^"]+)"',
+            r'"src":"([^"]*\.jpg[^"]*)"',
+            r'displayUrl":"([^"]+)"'
+        ]
+
+        for pattern in image_patterns:
+            match = re.search(pattern, html_content)
+            if match:
+                image_url = match.group(1).replace('\\u0026', '&').replace('\\/', '/')
+                return image_url, 'photo'
+
+        return None, None
+
+    except Exception:
+        return None, None
+
+def pad_page(text, filler):
+    """Bulk a saved page up to a realistic size with inline scripts, as the real site has"""
+    if filler <= 0 or '</head>' not in text:
+        return text
+    scripts = "".join(f'<script>requireLazy(["m{i}"],function(){{return {i};}});</script>\n' for i in range(filler))
+    return text.replace('</head>', '</head>' + scripts, 1)
+
+async def run_extraction(args, ports=None):
+    """Old regex extractor against the JSON parser on the saved page fixtures:
+    how many posts each gets exactly right, and pages parsed per second"""
+    bot = import_bot(args)
+    fixtures = load_fixtures(args.fixtures)["fixtures"]
+    extractors = {
+        "legacy": lambda text, shortcode: [
+            (media_type, url) for url, media_type in [legacy_extract_media(text)] if url],
+        "current": lambda text, shortcode: [
+            (item.media_type, item.url) for item in bot.downloader.extract_media_from_html(text, shortcode)],
+    }
+
+    report = {"pages": len(fixtures), "iterations": args.iterations, "per_fixture": {}}
+    pages = [pad_page(fixture["text"], args.page_filler) for fixture in fixtures]
+    report["avg_page_kb"] = round(sum(len(page) for page in pages) / len(pages) / 1024, 1)
+    for name, extract in extractors.items():
+        exact = found_right = wrong = expected_total = 0
+        for fixture, page in zip(fixtures, pages):
+            expected = [(e["type"], e["url"]) for e in fixture["expected"]]
+            found = extract(page, fixture["shortcode"])
+            right = sum(1 for item in found if item in expected)
+            exact += found == expected
+            found_right += right
+            wrong += len(found) - right
+            expected_total += len(expected)
+            report["per_fixture"].setdefault(fixture["file"], {})[name] = f"{right}/{len(expected)} right, {len(found) - right} wrong"
+
+        started = time.perf_counter()
+        for _ in range(args.iterations):
+            for fixture, page in zip(fixtures, pages):
+                extract(page, fixture["shortcode"])
+        elapsed = time.perf_counter() - started
+        report[name] = {
+            "posts_exact": f"{exact}/{len(fixtures)}",
+            "items_found": f"{found_right}/{expected_total}",
+            "wrong_items": wrong,
+            "pages_per_s": round(args.iterations * len(pages) / elapsed, 1),
+            "ms_per_page": round(elapsed / args.iterations / len(pages) * 1000, 3),
+        }
+    report["passed"] = (
+        report["current"]["posts_exact"] == f"{len(fixtures)}/{len(fixtures)}"
+        # Parsing properly must not cost speed against the regex cascade
+        and report["current"]["pages_per_s"] >= report["legacy"]["pages_per_s"]
+    )
+    return report
+
+def print_report(report):
+    latency = report["latency_s"]
+    print(f"requests:        {report['requests']} in {report['elapsed_s']} s "
+          f"({report['throughput_rps']} req/s)")
+    print(f"latency:         p50 {latency['p50']} s  p95 {latency['p95']} s  "
+          f"p99 {latency['p99']} s  max {latency['max']} s")
+    print(f"peak RSS:        {report['peak_rss_mb']} MB")
+    print(f"outcomes:        {report['outcomes']}")
+    print(f"cache:           {report['cache']}")
+    print(f"proxy attempts:  {report['bot_proxy_attempts']}")
+    print(f"fallbacks:       {report['endpoint_fallbacks']}")
+    fakes = report["fakes"]
+    print(f"instagram:       {fakes['instagram_pages']} pages, {fakes['instagram_media']} media, "
+          f"{fakes['instagram_failures']} injected failures")
+    print(f"proxies:         {sum(fakes['proxy_requests'].values())} requests, "
+          f"{sum(fakes['proxy_failures'].values())} injected failures")
+    print(f"telegram calls:  {fakes['telegram_calls']}")
+
+def print_summary(report, indent=""):
+    for key, value in report.items():
+        if isinstance(value, dict):
+            print(f"{indent}{key}:")
+            print_summary(value, indent + "  ")
+        else:
+            print(f"{indent}{f'{key}:':<28}{value}")
+
+# Scenarios that need no fake services
+OFFLINE_SCENARIOS = {"extraction"}
+
+# name -> (runner, argument defaults, printer)
+SCENARIOS = {
+    "load": (run_load, {}, print_report),
+    "concurrency": (run_concurrency, {
+        "requests": 20, "rate": 0, "proxy_failure_rate": 0.0, "bad_proxies": 0,
+    }, print_summary),
+    "extraction": (run_extraction, {}, print_summary),
+    "endpoints": (run_endpoints, {
+        "requests": 120, "rate": 10, "endpoint_script": "reels", "proxy_failure_rate": 0.0, "bad_proxies": 0,
+        # Small media, so page fetches and not the fakes' bandwidth decide the timings
+        "video_size": 256 * 1024, "photo_size": 64 * 1024,
+    }, print_summary),
+    "webhook": (run_webhook, {
+        # Updates arrive as one burst, so each mode runs at its capacity; a few posts, cached
+        # beforehand, so delivering updates rather than downloading dominates
+        "requests": 500, "shortcodes": 10, "rate": 0, "proxy_failure_rate": 0.0, "bad_proxies": 0,
+    }, print_summary),
+    "streaming": (run_streaming, {
+        "video_size": 64 * 1024 * 1024, "proxy_failure_rate": 0.0, "bad_proxies": 0,
+        "instagram_latency": (0.0, 0.0),
+    }, print_summary),
+    "workers": (run_workers, {
+        "requests": 120, "rate": 0, "proxy_failure_rate": 0.0, "bad_proxies": 0,
+        "video_size": 256 * 1024, "photo_size": 64 * 1024,
+    }, print_summary),
+}
+
+def parse_args(argv=None):
+    def span(value):
+        low, _, high = value.partition(',')
+        return float(low), float(high or low)
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', choices=SCENARIOS, default='load')
+    parser.add_argument('--requests', type=int, default=100, help="links to send")
+    parser.add_argument('--rate', type=float, default=10.0, help="arrival rate, requests/s (0 = all at once)")
+    parser.add_argument('--users', type=int, default=20, help="distinct users sending links")
+    parser.add_argument('--shortcodes', type=int, default=40, help="distinct posts")
+    parser.add_argument('--zipf', type=float, default=1.0, help="popularity skew of posts")
+    parser.add_argument('--carousel-share', type=float, default=0.2)
+    parser.add_argument('--carousel-items', type=int, default=5)
+    parser.add_argument('--page-filler', type=int, default=3000, help="filler scripts per page (~300KB)")
+    parser.add_argument('--video-size', type=int, default=4 * 1024 * 1024)
+    parser.add_argument('--photo-size', type=int, default=300 * 1024)
+    parser.add_argument('--instagram-latency', type=span, default=(0.05, 0.2), help="min,max seconds")
+    parser.add_argument('--instagram-failure-rate', type=float, default=0.0)
+    parser.add_argument('--endpoint-script', choices=ENDPOINT_SCRIPTS, default='default',
+                        help="which endpoints answer with a login wall, and how often")
+    parser.add_argument('--downloads', type=int, default=4, help="concurrent downloads (streaming)")
+    parser.add_argument('--pages', choices=('generated', 'fixtures'), default='generated',
+                        help="what the fake Instagram serves: generated pages or the saved fixtures")
+    parser.add_argument('--fixtures', default=FIXTURES_DIR, help="saved page fixtures (extraction, --pages)")
+    parser.add_argument('--iterations', type=int, default=50, help="passes over the fixtures (extraction)")
+    parser.add_argument('--worker-counts', type=lambda value: [int(n) for n in value.split(',')],
+                        default=[1, 2, 4], help="worker processes per run (workers)")
+    parser.add_argument('--worker-concurrency', type=int, default=2,
+                        help="DOWNLOAD_CONCURRENCY of each worker (workers)")
+    parser.add_argument('--proxies', type=int, default=5)
+    parser.add_argument('--proxy-latency', type=span, default=(0.01, 0.05), help="min,max seconds")
+    parser.add_argument('--proxy-failure-rate', type=float, default=0.02)
+    parser.add_argument('--proxy-block-rate', type=float, default=0.0, help="share of 429 responses")
+    parser.add_argument('--bad-proxies', type=int, default=1, help="proxies using --bad-proxy-failure-rate")
+    parser.add_argument('--bad-proxy-failure-rate', type=float, default=0.8)
+    parser.add_argument('--telegram-latency', type=span, default=(0.02, 0.1), help="min,max seconds")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    parser.add_argument('--verbose', action='store_true', help="keep the bot's INFO logs")
+    # Scenario defaults apply unless the option is given explicitly
+    known = parser.parse_known_args(argv)[0]
+    parser.set_defaults(**SCENARIOS[known.scenario][1])
+    if known.pages == 'fixtures':
+        # Each saved page answers at one endpoint only; login walls on top would lose whole posts
+        parser.set_defaults(endpoint_script='open')
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    random.seed(args.seed)
+    runner, _, printer = SCENARIOS[args.scenario]
+
+    if args.scenario in OFFLINE_SCENARIOS:
+        report = asyncio.run(runner(args))
+    else:
+        context = multiprocessing.get_context('spawn')
+        parent_conn, child_conn = context.Pipe()
+        fakes = context.Process(target=run_fakes, args=(args, child_conn), daemon=True)
+        fakes.start()
+        try:
+            ports = parent_conn.recv()
+            report = asyncio.run(runner(args, ports))
+        finally:
+            fakes.terminate()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        printer(report)
+    if report.get("passed") is False:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()